@@ -0,0 +1,4 @@
+import os
+
+# transcribe_parallel creates its boto3 clients on import, which needs a region
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
@@ -0,0 +1,138 @@
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+import transcribe_parallel as tp
+
+
+class FakeComprehend:
+    """Stands in for remove_pii, finding every occurrence of known PII strings and recording each request."""
+
+    def __init__(self):
+        self.entities = {}
+        self.requests = []
+        self.error = None
+
+    def __call__(self, text, language):
+        self.requests.append(text)
+        if self.error:
+            raise self.error
+        found = []
+        for value, entity_type in self.entities.items():
+            start = text.find(value)
+            while start >= 0:
+                found.append({'BeginOffset': start, 'EndOffset': start + len(value), 'Type': entity_type})
+                start = text.find(value, start + 1)
+        return sorted(found, key=lambda x: x['BeginOffset'])
+
+
+def make_timeline(*words):
+    return [{'text': word, 'start_time': '0.0', 'end_time': '0.0', 'speaker': 'spk_0'} for word in words]
+
+
+def texts(timeline):
+    return [item['text'] for item in timeline]
+
+
+@pytest.fixture(autouse=True)
+def clear_pii_cache():
+    tp.pii_cache.clear()
+    yield
+    tp.pii_cache.clear()
+
+
+@pytest.fixture
+def comprehend(monkeypatch):
+    fake = FakeComprehend()
+    monkeypatch.setattr(tp, 'remove_pii', fake)
+    return fake
+
+
+def test_split_entities_clips_entities_to_each_piece():
+    # "ab cd\nef", an entity covering "cd\ne" crosses the separator
+    entities = [{'BeginOffset': 3, 'EndOffset': 7, 'Type': 'NAME'}]
+    assert tp.split_entities(entities, [5, 2]) == [
+        [{'BeginOffset': 3, 'EndOffset': 5, 'Type': 'NAME'}],
+        [{'BeginOffset': 0, 'EndOffset': 1, 'Type': 'NAME'}],
+    ]
+
+
+def test_items_after_a_redaction_stay_aligned(comprehend):
+    comprehend.entities = {'Alice': 'NAME', '555 0100': 'PHONE'}
+    timeline = make_timeline('this', 'is', "Alice's", 'phone', ',', 'call', '555', '0100', 'now', '.')
+
+    [redacted], pattern_redacted = tp.detect_pii_entities([timeline], 'en')
+
+    assert texts(redacted) == [
+        'this', 'is', "[REDACTED: NAME]'s", 'phone', ',', 'call',
+        '[REDACTED: PHONE]', '[REDACTED: PHONE]', 'now', '.',
+    ]
+    assert pattern_redacted == set()
+
+
+def test_entity_spanning_two_items(comprehend):
+    comprehend.entities = {'Alice Smith': 'NAME'}
+    timeline = make_timeline('ask', 'Alice', 'Smith', 'today')
+
+    [redacted], _ = tp.detect_pii_entities([timeline], 'en')
+
+    assert texts(redacted) == ['ask', '[REDACTED: NAME]', '[REDACTED: NAME]', 'today']
+
+
+def test_entity_spanning_the_separator_between_sentences(comprehend):
+    comprehend.entities = {'Bob .\nSmith': 'NAME'}
+    timeline = make_timeline('call', 'Bob', '.', 'Smith', 'tomorrow')
+
+    [redacted], _ = tp.detect_pii_entities([timeline], 'en')
+
+    assert comprehend.requests == ['call Bob .\nSmith tomorrow']
+    assert texts(redacted) == ['call', '[REDACTED: NAME]', '[REDACTED: NAME]', '[REDACTED: NAME]', 'tomorrow']
+
+
+def test_repeated_sentences_are_served_from_the_cache(comprehend):
+    comprehend.entities = {'Alice': 'NAME'}
+    timelines = [
+        make_timeline('hello', 'Alice', '.', 'bye', '.'),
+        make_timeline('hello', 'Alice', '.', 'later', '.'),
+    ]
+
+    redacted, _ = tp.detect_pii_entities(timelines, 'en')
+
+    assert comprehend.requests == ['hello Alice .\nbye .\nlater .']
+    assert texts(redacted[0]) == ['hello', '[REDACTED: NAME]', '.', 'bye', '.']
+    assert texts(redacted[1]) == ['hello', '[REDACTED: NAME]', '.', 'later', '.']
+
+    [redacted], _ = tp.detect_pii_entities([make_timeline('hello', 'Alice', '.')], 'en')
+
+    assert len(comprehend.requests) == 1
+    assert texts(redacted) == ['hello', '[REDACTED: NAME]', '.']
+
+
+@pytest.mark.parametrize('error', [
+    ClientError({'Error': {'Code': 'InternalServerException', 'Message': 'down'}}, 'DetectPiiEntities'),
+    EndpointConnectionError(endpoint_url='https://comprehend.us-east-1.amazonaws.com'),
+])
+def test_pattern_fallback_marks_its_timelines(comprehend, error):
+    tp.detect_pii_entities([make_timeline('nothing', 'to', 'hide')], 'en')
+    comprehend.error = error
+    timelines = [
+        make_timeline('mail', 'bob@example.com', 'or', 'Alice'),
+        make_timeline('nothing', 'to', 'hide'),
+    ]
+
+    redacted, pattern_redacted = tp.detect_pii_entities(timelines, 'en')
+
+    # Only the timeline that needed Comprehend is marked, the other came from the cache
+    assert pattern_redacted == {0}
+    assert texts(redacted[0]) == ['mail', '[REDACTED: EMAIL]', 'or', 'Alice']
+    assert texts(redacted[1]) == ['nothing', 'to', 'hide']
+
+    comprehend.error = None
+    comprehend.entities = {'bob@example.com': 'EMAIL', 'Alice': 'NAME'}
+    [redacted], pattern_redacted = tp.detect_pii_entities(
+        [make_timeline('mail', 'bob@example.com', 'or', 'Alice')], 'en'
+    )
+
+    # Pattern results are not cached, so the sentence goes to Comprehend again
+    assert comprehend.requests[-1] == 'mail bob@example.com or Alice'
+    assert pattern_redacted == set()
+    assert texts(redacted) == ['mail', '[REDACTED: EMAIL]', 'or', '[REDACTED: NAME]']
@@ -1,38 +1,77 @@
+import atexit
 import boto3
+import csv
+import gzip
+import hashlib
+import heapq
+import ijson
+import itertools
 import json
+import logging
 import time
 import os
+import sys
+import random
+import re
 import uuid
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from collections import OrderedDict, deque
+from botocore.exceptions import BotoCoreError, ClientError
 from queue import Queue, Empty
 from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from urllib.parse import unquote_plus
 from dotenv import load_dotenv
+from fastrlock.rlock import FastRLock
 import threading
 
 load_dotenv()
 
-# Initialize clients
-s3 = boto3.client('s3')
-transcribe = boto3.client('transcribe')
-comprehend = boto3.client('comprehend')
+# Log through a queue so worker threads hand records off instead of waiting on stdout
+log_queue = Queue()
+log_listener = QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+logging.basicConfig(format="%(message)s", handlers=[QueueHandler(log_queue)])
+logger = logging.getLogger("transcribe_parallel")
+logger.setLevel(logging.INFO)
+
+# Initialize clients with a connection pool large enough for the IO pool below
+client_config = Config(max_pool_connections=64)
+s3 = boto3.client('s3', config=client_config)
+transcribe = boto3.client('transcribe', config=client_config)
+comprehend = boto3.client('comprehend', config=client_config)
 
 # Configuration
 input_bucket = os.getenv("AUDIO_INPUT_BUCKET")
 transcription_bucket = os.getenv("AUDIO_TRANSCRIPTION_BUCKET")
 redaction_bucket = os.getenv("AUDIO_TRANSCRIPTION_REDACTION_BUCKET")
 language_support = os.getenv("AUDIO_LANGUAGE_SUPPORT", "en-IN,hi-IN").split(",")
-thread_count = int(os.getenv("THREAD_COUNT", "4"))
+# Pollers and redactors spend their time waiting on AWS, so size them for IO rather than CPU
+default_workers = max(8, (os.cpu_count() or 1) * 5)
+status_pollers = max(1, int(os.getenv("STATUS_POLLERS", default_workers)))
+redaction_workers = max(1, int(os.getenv("REDACTION_WORKERS", default_workers)))
 max_parallel_jobs = int(os.getenv("MAX_PARALLEL_JOBS", "5"))
+use_s3_inventory = os.getenv("USE_S3_INVENTORY", "false").lower() == "true"
+inventory_bucket = os.getenv("S3_INVENTORY_BUCKET")
+inventory_prefix = os.getenv("S3_INVENTORY_PREFIX", "")
+use_transcribe_redaction = os.getenv("USE_TRANSCRIBE_REDACTION", "false").lower() == "true"
+pii_cache_size = max(0, int(os.getenv("PII_CACHE_SIZE", "10000")))
+
+logger.info("Configuration:")
+logger.info("-----------------------------")
+logger.info(f"Input Bucket:                 {input_bucket}")
+logger.info(f"Transcription Bucket:         {transcription_bucket}")
+logger.info(f"Redaction Bucket:             {redaction_bucket}")
+logger.info(f"Supported Languages:          {', '.join(language_support)}")
+logger.info(f"Status Pollers:               {status_pollers}")
+logger.info(f"Redaction Workers:            {redaction_workers}")
+logger.info(f"Max Parallel Jobs:            {max_parallel_jobs}")
+logger.info(f"PII Redaction:                {'Transcribe' if use_transcribe_redaction else 'Comprehend'}")
+if use_s3_inventory:
+    logger.info(f"S3 Inventory:                 s3://{inventory_bucket}/{inventory_prefix}")
+logger.info("-----------------------------")
 
-print("Configuration:")
-print("-----------------------------")
-print(f"Input Bucket:                 {input_bucket}")
-print(f"Transcription Bucket:         {transcription_bucket}")
-print(f"Redaction Bucket:             {redaction_bucket}")
-print(f"Supported Languages:          {', '.join(language_support)}")
-print(f"Thread Count:                 {thread_count}")
-print(f"Max Parallel Jobs:            {max_parallel_jobs}")
-print("-----------------------------")
+# Thread pool for S3 reads and writes issued by the redaction workers, one thread per pooled connection
+io_pool = ThreadPoolExecutor(max_workers=client_config.max_pool_connections)
 
 # Queues
 audio_file_queue = Queue()
@@ -44,203 +83,699 @@ all_files_processed = threading.Event()
 all_transcriptions_complete = threading.Event()
 all_redactions_complete = threading.Event()
 
-# Counter for completed jobs
-completed_jobs = 0
-jobs_lock = threading.Lock()
+# Counter for completed jobs, next() on it is atomic so no lock is needed
+completed_jobs = itertools.count()
+
+# Redaction cache key of each started job, keyed by job name
+cache_keys = {}
+
+# Slots for in-flight transcription jobs, released when a job reaches a terminal status
+slot = threading.BoundedSemaphore(max_parallel_jobs)
+
+# Comprehend accepts up to 100 KB of UTF-8 text per DetectPiiEntities request
+MAX_PII_TEXT_BYTES = 100000
+# Completed jobs redacted together, and how long to wait for more before redacting a batch
+REDACTION_BATCH_SIZE = 25
+REDACTION_BATCH_WAIT = 0.5
+# Failed status checks in a row before a transcription job is given up on
+MAX_POLL_ERRORS = 5
+# Transcribe media format of each supported audio file extension
+MEDIA_FORMATS = {
+    '.mp3': 'mp3',
+    '.mp4': 'mp4',
+    '.m4a': 'm4a',
+    '.wav': 'wav',
+    '.flac': 'flac',
+    '.ogg': 'ogg',
+    '.amr': 'amr',
+    '.webm': 'webm'
+}
+# Common PII patterns, used to redact text when Comprehend cannot be reached
+PII_RE = re.compile(
+    r'(?P<EMAIL>[\w.+-]+@[\w-]+\.[\w.-]+)'
+    r'|(?P<SSN>\b\d{3}-\d{2}-\d{4}\b)'
+    r'|(?P<PHONE>\+?\d[\d ().-]{7,}\d)'
+)
+# Held while a redaction worker collects a batch
+drain_lock = FastRLock()
+
+# Comprehend entities of recently seen sentences, least recently used first
+pii_cache = OrderedDict()
+pii_cache_lock = FastRLock()
 
 def list_files(bucket):
-    """List all files in an S3 bucket."""
-    response = s3.list_objects_v2(Bucket=bucket)
-    if 'Contents' in response:
-        return [item['Key'] for item in response['Contents']]
-    return []
+    """List all files in an S3 bucket, yielding keys page by page."""
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket):
+        for item in page.get('Contents', []):
+            yield item['Key']
+
+def get_inventory_manifest(bucket, prefix):
+    """Load the manifest of the latest S3 Inventory report under a prefix, or None if there is none."""
+    prefix = f"{prefix.rstrip('/')}/" if prefix else ''
+    try:
+        # Reports are delivered to dated folders, e.g. 2024-09-10T01-00Z/manifest.json
+        paginator = s3.get_paginator('list_objects_v2')
+        reports = [
+            common_prefix['Prefix']
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/')
+            for common_prefix in page.get('CommonPrefixes', [])
+            if common_prefix['Prefix'][len(prefix):][:1].isdigit()
+        ]
+        if not reports:
+            return None
+        response = s3.get_object(Bucket=bucket, Key=f'{max(reports)}manifest.json')
+        manifest = json.loads(response['Body'].read())
+    except (BotoCoreError, ClientError, ValueError) as e:
+        logger.error(f'Error reading S3 Inventory manifest from {bucket}: {e}')
+        return None
+    if not isinstance(manifest, dict):
+        logger.warning(f'Malformed S3 Inventory manifest in {bucket}.')
+        return None
+    if manifest.get('fileFormat') != 'CSV':
+        logger.warning(f"Unsupported S3 Inventory format: {manifest.get('fileFormat')}")
+        return None
+    # list_inventory_files needs the Key column and the list of report files
+    columns = [column.strip() for column in str(manifest.get('fileSchema', '')).split(',')]
+    if 'Key' not in columns or not isinstance(manifest.get('files'), list):
+        logger.warning(f'Malformed S3 Inventory manifest in {bucket}.')
+        return None
+    return manifest
+
+def list_inventory_files(bucket, manifest):
+    """List all files in an S3 Inventory report, yielding keys as each report file is read."""
+    columns = [column.strip() for column in manifest['fileSchema'].split(',')]
+    key_index = columns.index('Key')
+    latest_index = columns.index('IsLatest') if 'IsLatest' in columns else None
+    delete_marker_index = columns.index('IsDeleteMarker') if 'IsDeleteMarker' in columns else None
+    for report_file in manifest['files']:
+        response = s3.get_object(Bucket=bucket, Key=report_file['key'])
+        with gzip.open(response['Body'], 'rt', encoding='utf-8', newline='') as rows:
+            for row in csv.reader(rows):
+                # Skip old versions and delete markers of versioned buckets
+                if latest_index is not None and row[latest_index] != 'true':
+                    continue
+                if delete_marker_index is not None and row[delete_marker_index] == 'true':
+                    continue
+                # Inventory reports URL-encode object keys
+                yield unquote_plus(row[key_index])
+
+def list_input_files():
+    """List the files in the input bucket, from the latest S3 Inventory report when enabled."""
+    if use_s3_inventory:
+        manifest = get_inventory_manifest(inventory_bucket, inventory_prefix)
+        if not manifest:
+            logger.info("No S3 Inventory report found, listing the input bucket instead.")
+        elif manifest.get('sourceBucket') != input_bucket:
+            # Keys from a report of another bucket would start jobs for objects that do not exist
+            logger.warning(f"S3 Inventory report is of {manifest.get('sourceBucket')}, not {input_bucket}, listing the input bucket instead.")
+        else:
+            logger.info(f"Listing audio files from S3 Inventory report of {input_bucket}")
+            return list_inventory_files(inventory_bucket, manifest)
+    return list_files(input_bucket)
+
+def get_media_format(audio_file_key):
+    """Get the Transcribe media format of an audio file from its extension, or None if unsupported."""
+    return MEDIA_FORMATS.get(os.path.splitext(audio_file_key)[1].lower())
+
+def list_audio_files():
+    """List the audio files to transcribe, skipping files Transcribe cannot read."""
+    for audio_file_key in list_input_files():
+        if get_media_format(audio_file_key):
+            yield audio_file_key
+        else:
+            logger.info(f'Skipping {audio_file_key}, unsupported media format.')
 
 def generate_unique_job_name():
     """Generate a unique job name using UUID."""
     return f"job-{uuid.uuid4().hex[:8]}"
 
-def start_transcription_job(audio_file_key):
+def get_fingerprint(audio_file_key):
+    """Fingerprint the content of an audio file and the transcription settings, or None if it cannot be read."""
+    try:
+        head = s3.head_object(Bucket=input_bucket, Key=audio_file_key)
+    except (BotoCoreError, ClientError) as e:
+        logger.error(f'Error reading metadata of {audio_file_key}: {e}')
+        return None
+    etag = head['ETag'].strip('"')
+    return f"{etag}:{','.join(language_support)}:{use_transcribe_redaction}"
+
+def get_cache_key(fingerprint):
+    """Build the redaction cache key of a fingerprint, shared by all audio files with the same content."""
+    return f"cache/{hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()}.json"
+
+def get_job_name(audio_file_key, fingerprint):
+    """Name the transcription job of an audio file after its key, content and output bucket, so reruns find the same job."""
+    job_input = f"{input_bucket}/{audio_file_key}\n{transcription_bucket}\n{fingerprint}"
+    digest = hashlib.sha256(job_input.encode('utf-8')).hexdigest()
+    return f"job-{digest[:16]}"
+
+def is_redacted(job_name):
+    """Check whether the redacted transcription of a job was already saved, by Comprehend or Transcribe."""
+    try:
+        head = s3.head_object(Bucket=redaction_bucket, Key=f'redacted_{job_name}.json')
+        # Redactions saved by the pattern fallback are marked, see redact_jobs
+        if head.get('Metadata', {}).get('pii-fallback') == 'patterns':
+            logger.info(f'Redacted transcription for job {job_name} was only pattern redacted, redacting it again.')
+            return False
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            logger.error(f'Error checking redacted transcription for {job_name}: {e}')
+        return False
+    except BotoCoreError as e:
+        logger.error(f'Error checking redacted transcription for {job_name}: {e}')
+        return False
+
+def copy_cached_redaction(audio_file_key, cache_key, job_name):
+    """Copy a cached redacted transcription into place for a job. Returns False on a cache miss."""
+    try:
+        s3.head_object(Bucket=redaction_bucket, Key=cache_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            logger.error(f'Error reading redaction cache for {audio_file_key}: {e}')
+        return False
+    except BotoCoreError as e:
+        logger.error(f'Error reading redaction cache for {audio_file_key}: {e}')
+        return False
+    redacted_key = f'redacted_{job_name}.json'
+    try:
+        s3.copy_object(
+            Bucket=redaction_bucket,
+            Key=redacted_key,
+            CopySource={'Bucket': redaction_bucket, 'Key': cache_key}
+        )
+    except (BotoCoreError, ClientError) as e:
+        logger.error(f'Error copying cached redaction for {audio_file_key}: {e}')
+        return False
+    logger.info(f'Reused cached redaction for {audio_file_key} as {redacted_key}')
+    return True
+
+def prepare_transcription_job(audio_file_key):
+    """Name the transcription job of an audio file and check whether its redaction is already saved.
+
+    Returns the job name, the cache key of the file, and whether the redacted
+    transcription is in place, either from an earlier run or from the cache.
+    """
+    fingerprint = get_fingerprint(audio_file_key)
+    if not fingerprint:
+        return generate_unique_job_name(), None, False
+    job_name = get_job_name(audio_file_key, fingerprint)
+    cache_key = get_cache_key(fingerprint)
+    if is_redacted(job_name):
+        logger.info(f'Redacted transcription for {audio_file_key} already exists, skipping.')
+        return job_name, cache_key, True
+    return job_name, cache_key, copy_cached_redaction(audio_file_key, cache_key, job_name)
+
+def delete_failed_transcription_job(job_name):
+    """Delete a transcription job an earlier run left FAILED, so it can be started again. Returns whether it was deleted."""
+    try:
+        response = transcribe.get_transcription_job(TranscriptionJobName=job_name)
+        if response['TranscriptionJob']['TranscriptionJobStatus'] != 'FAILED':
+            return False
+        transcribe.delete_transcription_job(TranscriptionJobName=job_name)
+    except (BotoCoreError, ClientError) as e:
+        logger.error(f'Error deleting failed transcription job {job_name}: {e}')
+        return False
+    logger.info(f'Deleted failed transcription job {job_name} of an earlier run.')
+    return True
+
+def start_transcription_job(audio_file_key, job_name, cache_key=None):
     """Start a transcription job for a single audio file."""
-    job_name = generate_unique_job_name()
     audio_file_uri = f's3://{input_bucket}/{audio_file_key}'
+    # Language identification needs at least two candidate languages
+    if len(language_support) > 1:
+        job_options = {'IdentifyLanguage': True, 'LanguageOptions': language_support}
+    else:
+        job_options = {'LanguageCode': language_support[0]}
+    if use_transcribe_redaction:
+        job_options['ContentRedaction'] = {
+            'RedactionType': 'PII',
+            'RedactionOutput': 'redacted',
+            'PiiEntityTypes': ['ALL']
+        }
+    job_request = dict(
+        TranscriptionJobName=job_name,
+        Media={'MediaFileUri': audio_file_uri},
+        MediaFormat=get_media_format(audio_file_key),
+        OutputBucketName=transcription_bucket,
+        Settings={
+            'ShowSpeakerLabels': True,
+            'MaxSpeakerLabels': 2
+        },
+        **job_options
+    )
     try:
-        transcribe.start_transcription_job(
-            TranscriptionJobName=job_name,
-            Media={'MediaFileUri': audio_file_uri},
-            MediaFormat='mp3',
-            IdentifyLanguage=True,
-            LanguageOptions=language_support,
-            OutputBucketName=transcription_bucket,
-            Settings={
-                'ShowSpeakerLabels': True,
-                'MaxSpeakerLabels': 2
-            }
-        )
-        print(f'Started transcription job {job_name} for {audio_file_key}')
-        transcription_queue.put(job_name)
+        try:
+            transcribe.start_transcription_job(**job_request)
+        except ClientError as e:
+            # A job an earlier run left FAILED would fail every later run too, so start it afresh
+            if e.response['Error']['Code'] != 'ConflictException' or not delete_failed_transcription_job(job_name):
+                raise
+            transcribe.start_transcription_job(**job_request)
+        logger.info(f'Started transcription job {job_name} for {audio_file_key}')
     except ClientError as e:
-        print(f'Error starting transcription job for {audio_file_key}: {e}')
+        if e.response['Error']['Code'] != 'ConflictException':
+            logger.error(f'Error starting transcription job for {audio_file_key}: {e}')
+            slot.release()
+            return
+        # An earlier run started this job but did not save its redaction, so pick the job up again
+        logger.info(f'Transcription job {job_name} for {audio_file_key} already exists, waiting for it.')
+    except BotoCoreError as e:
+        logger.error(f'Error starting transcription job for {audio_file_key}: {e}')
+        slot.release()
+        return
+    if cache_key:
+        cache_keys[job_name] = cache_key
+    transcription_queue.put(job_name)
 
 def manage_transcription_jobs():
     """Manage the starting of transcription jobs."""
-    while not all_files_processed.is_set() or not audio_file_queue.empty():
-        if transcription_queue.qsize() < max_parallel_jobs and not audio_file_queue.empty():
-            audio_file_key = audio_file_queue.get()
-            start_transcription_job(audio_file_key)
-            audio_file_queue.task_done()
+    # Redaction and cache lookups of upcoming files run on the IO pool while jobs are started in order
+    lookups = deque()
+    while not all_files_processed.is_set() or not audio_file_queue.empty() or lookups:
+        while len(lookups) < client_config.max_pool_connections:
+            try:
+                audio_file_key = audio_file_queue.get(block=not lookups, timeout=5)
+            except Empty:
+                break
+            lookups.append((audio_file_key, io_pool.submit(prepare_transcription_job, audio_file_key)))
+        if not lookups:
+            continue
+        audio_file_key, lookup = lookups.popleft()
+        try:
+            job_name, cache_key, redacted = lookup.result()
+        except Exception as e:
+            logger.error(f'Error looking up cached redaction for {audio_file_key}: {e}')
+            job_name, cache_key, redacted = generate_unique_job_name(), None, False
+        # Files whose content was already redacted skip the whole pipeline
+        if redacted:
+            next(completed_jobs)
         else:
-            time.sleep(5)
-    print("All transcription jobs have been started.")
+            slot.acquire()
+            start_transcription_job(audio_file_key, job_name, cache_key)
+        audio_file_queue.task_done()
+    logger.info("All transcription jobs have been started.")
+
+def poll_transcription_job(job_name):
+    """Get the status and language of a transcription job, or THROTTLED or ERROR if it could not be read this time."""
+    try:
+        response = transcribe.get_transcription_job(TranscriptionJobName=job_name)
+        job = response['TranscriptionJob']
+        return job['TranscriptionJobStatus'], job.get('LanguageCode')
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('ThrottlingException', 'LimitExceededException'):
+            logger.warning(f'Throttled while checking transcription job {job_name}. Backing off...')
+            return 'THROTTLED', None
+        logger.error(f'Error checking transcription job {job_name}: {e}')
+        return 'ERROR', None
+    except BotoCoreError as e:
+        logger.error(f'Error checking transcription job {job_name}: {e}')
+        return 'ERROR', None
+
+def finish_transcription_job(job_name, status, language=None):
+    """Hand a COMPLETED or FAILED transcription job over to the next stage."""
+    # Free the job's slot whatever happened to it, or the window would shrink for good
+    slot.release()
+    next(completed_jobs)
+    if status == 'COMPLETED':
+        logger.info(f'Transcription job {job_name} completed.')
+        redaction_queue.put((job_name, language))
+    else:
+        logger.info(f'Transcription job {job_name} failed.')
+        cache_keys.pop(job_name, None)
+    transcription_queue.task_done()
 
 def check_transcription_job_status():
-    """Worker to check the status of transcription jobs."""
-    global completed_jobs
-    while not all_files_processed.is_set() or not transcription_queue.empty():
+    """Worker to check the status of transcription jobs.
+
+    Each worker tracks many jobs at once and polls whichever is due next, so the
+    number of jobs in flight is not limited by the number of workers.
+    """
+    # Heap of (next poll time, job name, backoff delay, failed checks in a row),
+    # polled with exponential backoff and jitter, starting at 2s and capped at 30s
+    jobs = []
+    while jobs or not all_files_processed.is_set() or not transcription_queue.empty():
+        # Take on new jobs while waiting for the next poll to be due
+        timeout = max(0, jobs[0][0] - time.monotonic()) if jobs else 5
         try:
-            job_name = transcription_queue.get(timeout=5)
-            while True:
-                response = transcribe.get_transcription_job(TranscriptionJobName=job_name)
-                status = response['TranscriptionJob']['TranscriptionJobStatus']
-                if status == 'COMPLETED':
-                    print(f'Transcription job {job_name} completed.')
-                    redaction_queue.put(job_name)
-                    with jobs_lock:
-                        completed_jobs += 1
-                    break
-                elif status == 'FAILED':
-                    print(f'Transcription job {job_name} failed.')
-                    with jobs_lock:
-                        completed_jobs += 1
-                    break
-                print(f'Transcription job {job_name} is {status}. Waiting...')
-                time.sleep(30)
-            transcription_queue.task_done()
+            job_name = transcription_queue.get(timeout=timeout)
+            heapq.heappush(jobs, (time.monotonic(), job_name, 2.0, 0))
         except Empty:
+            pass
+        if not jobs or jobs[0][0] > time.monotonic():
             continue
-    print("All transcription jobs have been processed.")
+        _, job_name, delay, errors = heapq.heappop(jobs)
+        try:
+            status, language = poll_transcription_job(job_name)
+        except Exception as e:
+            logger.error(f'Error checking transcription job {job_name}: {e}')
+            status, language = 'ERROR', None
+        # The job may still be running after a failed check, so only give up on
+        # it, and free its slot, once checks keep failing
+        if status == 'ERROR':
+            errors += 1
+            if errors >= MAX_POLL_ERRORS:
+                logger.error(f'Giving up on transcription job {job_name} after {errors} failed status checks.')
+                status = 'FAILED'
+        if status in ('COMPLETED', 'FAILED'):
+            finish_transcription_job(job_name, status, language)
+        elif status in ('THROTTLED', 'ERROR'):
+            next_poll = time.monotonic() + delay + random.uniform(0, delay)
+            heapq.heappush(jobs, (next_poll, job_name, min(delay * 2, 30), errors))
+        else:
+            logger.info(f'Transcription job {job_name} is {status}. Waiting...')
+            next_poll = time.monotonic() + delay + random.uniform(0, delay / 2)
+            heapq.heappush(jobs, (next_poll, job_name, min(delay * 1.7, 30), 0))
+    logger.info("All transcription jobs have been processed.")
 
 def get_transcription_result(job_name):
-    """Retrieve transcription result from S3."""
+    """Retrieve transcription result from S3, streaming the transcript JSON."""
+    # Transcribe names the transcript it redacted itself redacted-<job name>.json
+    transcript_key = f'redacted-{job_name}.json' if use_transcribe_redaction else f'{job_name}.json'
     try:
-        response = s3.get_object(Bucket=transcription_bucket, Key=f'{job_name}.json')
-        body = response['Body'].read()
-        content = body.decode('utf-8')
-        transcript_text = json.loads(content)
+        response = s3.get_object(Bucket=transcription_bucket, Key=transcript_key)
         timeline = []
-        segments = transcript_text['results']['items']
-        language = transcript_text['results']['language_code']
-        for segment in segments:
-            if 'alternatives' in segment:
-                for alt in segment['alternatives']:
-                    if 'content' in alt:
-                        timeline.append({
-                            'text': alt['content'],
-                            'start_time': segment.get('start_time', '0.0'),
-                            'end_time': segment.get('end_time', '0.0'),
-                            'speaker': segment.get('speaker_label', 'Speaker')
-                        })
-        return timeline, language
-    except ClientError as e:
-        print(f'Error retrieving transcription result for {job_name}: {e}')
-        return None, None
-
-def detect_pii_entities(timeline, language):
-    """Detect PII entities in the text using Amazon Comprehend."""
-    try:
-        dialogues = [x['text'] for x in timeline]
-        concat = " ".join(dialogues)
-        removed_pii = remove_pii(concat, language)
-        redacted = removed_pii.split()
-        index = 0
-        for item in timeline:
-            words = item['text'].split()
-            item['text'] = " ".join(redacted[index:index+len(words)])
-            index += len(words)
+        # Build one item at a time instead of loading the whole transcript. The
+        # language comes from the job itself, so only the items are read here.
+        for segment in ijson.items(response['Body'], 'results.items.item'):
+            for alt in segment.get('alternatives', []):
+                if 'content' in alt:
+                    timeline.append({
+                        'text': alt['content'],
+                        'start_time': segment.get('start_time', '0.0'),
+                        'end_time': segment.get('end_time', '0.0'),
+                        'speaker': segment.get('speaker_label', 'Speaker')
+                    })
         return timeline
-    except ClientError as e:
-        print(f'Error detecting PII entities: {e}')
-        return []
+    except (BotoCoreError, ClientError, ijson.JSONError) as e:
+        logger.error(f'Error retrieving transcription result for {job_name}: {e}')
+        return None
+
+def comprehend_language(language):
+    """Map a Transcribe language code to a language supported by Comprehend PII detection."""
+    code = (language or 'en').split('-')[0]
+    return code if code in ('en', 'es') else 'en'
+
+def pack_documents(documents):
+    """Group document indexes into batches whose text fits in a single Comprehend request."""
+    batch, size = [], 0
+    for index, document in enumerate(documents):
+        length = len(document.encode('utf-8')) + 1
+        if batch and size + length > MAX_PII_TEXT_BYTES:
+            yield batch
+            batch, size = [], 0
+        batch.append(index)
+        size += length
+    if batch:
+        yield batch
+
+def split_sentences(timeline):
+    """Split a timeline into sentences, as (start, end) ranges of item indexes."""
+    sentences = []
+    start = 0
+    for index, item in enumerate(timeline):
+        if item['text'] in ('.', '?', '!'):
+            sentences.append((start, index + 1))
+            start = index + 1
+    if start < len(timeline):
+        sentences.append((start, len(timeline)))
+    return sentences
+
+def split_entities(entities, lengths):
+    """Split sorted entities found in pieces of text joined by one separator character.
+
+    Returns the entities of each piece with offsets relative to that piece. An
+    entity crossing several pieces is clipped to each of them.
+    """
+    pieces = []
+    offset = 0
+    first = 0
+    for length in lengths:
+        end = offset + length
+        while first < len(entities) and entities[first]['EndOffset'] <= offset:
+            first += 1
+        piece = []
+        last = first
+        while last < len(entities) and entities[last]['BeginOffset'] < end:
+            entity = entities[last]
+            begin_offset = max(entity['BeginOffset'], offset) - offset
+            end_offset = min(entity['EndOffset'], end) - offset
+            if begin_offset < end_offset:
+                piece.append({'BeginOffset': begin_offset, 'EndOffset': end_offset, 'Type': entity['Type']})
+            last += 1
+        pieces.append(piece)
+        offset = end + 1
+    return pieces
+
+def pii_cache_key(text, language):
+    """Key of a sentence in the PII cache."""
+    return hashlib.sha1(f'{language}\n{text}'.encode('utf-8')).hexdigest()
+
+def get_cached_entities(key):
+    """Get the cached entities of a sentence, or None if it was not seen recently."""
+    with pii_cache_lock:
+        entities = pii_cache.get(key)
+        if entities is not None:
+            pii_cache.move_to_end(key)
+        return entities
+
+def cache_entities(key, entities):
+    """Cache the entities of a sentence, evicting the least recently used sentences."""
+    if not pii_cache_size:
+        return
+    with pii_cache_lock:
+        pii_cache[key] = entities
+        pii_cache.move_to_end(key)
+        while len(pii_cache) > pii_cache_size:
+            pii_cache.popitem(last=False)
+
+def detect_pii_entities(timelines, language):
+    """Detect PII entities in a batch of timelines using Amazon Comprehend.
+
+    Sentences that were not seen recently are joined with newlines and sent
+    together, so repeated sentences and several small transcripts cost as few
+    Comprehend requests as possible. Entities are mapped back to the timeline
+    items they overlap by character offset.
+
+    Returns the redacted timelines and the indexes of the ones that were
+    partly redacted by pattern matching because Comprehend failed.
+    """
+    sentences = []
+    for index, timeline in enumerate(timelines):
+        for start, end in split_sentences(timeline):
+            text = " ".join(item['text'] for item in timeline[start:end])
+            sentences.append((index, start, end, text))
+
+    # Look up each distinct sentence once, and only send the ones not cached
+    sentence_entities = {}
+    for _, _, _, text in sentences:
+        if text not in sentence_entities:
+            sentence_entities[text] = get_cached_entities(pii_cache_key(text, language))
+    pending = [text for text, entities in sentence_entities.items() if entities is None]
+    pattern_redacted = set()
+    for batch in pack_documents(pending):
+        texts = [pending[i] for i in batch]
+        text = "\n".join(texts)
+        try:
+            entities = remove_pii(text, language)
+            cacheable = True
+        except (BotoCoreError, ClientError) as e:
+            # Redact what the patterns catch rather than dropping the transcripts,
+            # but leave the sentences uncached so Comprehend sees them next time
+            logger.error(f'Error detecting PII entities, redacting common patterns instead: {e}')
+            entities = find_pii_patterns(text)
+            cacheable = False
+            pattern_redacted.update(texts)
+        for text, found in zip(texts, split_entities(entities, [len(text) for text in texts])):
+            sentence_entities[text] = found
+            if cacheable:
+                cache_entities(pii_cache_key(text, language), found)
+
+    pattern_redacted_timelines = set()
+    for index, start, end, text in sentences:
+        if text in pattern_redacted:
+            pattern_redacted_timelines.add(index)
+        entities = sentence_entities[text]
+        if not entities:
+            continue
+        items = timelines[index][start:end]
+        for item, item_entities in zip(items, split_entities(entities, [len(item['text']) for item in items])):
+            if item_entities:
+                item['text'] = redact_text(item['text'], item_entities)
+    return timelines, pattern_redacted_timelines
 
 def remove_pii(text, language):
+    """Find the PII entities to redact in the text, sorted by offset."""
     response = comprehend.detect_pii_entities(
         Text=text,
         LanguageCode=language 
     )
-    for entity in sorted(response['Entities'], key=lambda x: x['BeginOffset'], reverse=True):
-        start = entity['BeginOffset']
-        end = entity['EndOffset']
-        pii_type = entity['Type']
-        
-        if pii_type != "DATE_TIME":
-            text = text[:start] + f'[REDACTED: {pii_type}]' + text[end:]
-    return text
+    entities = [entity for entity in response['Entities'] if entity['Type'] != "DATE_TIME"]
+    return sorted(entities, key=lambda x: x['BeginOffset'])
+
+def find_pii_patterns(text):
+    """Find common PII patterns in the text, as entities sorted by offset."""
+    return [
+        {'BeginOffset': match.start(), 'EndOffset': match.end(), 'Type': match.lastgroup}
+        for match in PII_RE.finditer(text)
+    ]
+
+def redact_text(text, entities):
+    """Replace the parts of the text covered by the sorted entities."""
+    # Build the redacted text in one pass instead of re-slicing it for every entity
+    redacted = []
+    cursor = 0
+    for entity in entities:
+        start = max(entity['BeginOffset'], cursor)
+        end = min(entity['EndOffset'], len(text))
+        if start >= end:
+            continue
+        redacted.append(text[cursor:start])
+        redacted.append(f"[REDACTED: {entity['Type']}]")
+        cursor = end
+    redacted.append(text[cursor:])
+    return "".join(redacted)
+
+def redact_jobs(batch):
+    """Redact a batch of (job name, language code) transcription jobs and save them."""
+    job_names = [job_name for job_name, _ in batch]
+    batch_cache_keys = {job_name: cache_keys.pop(job_name, None) for job_name in job_names}
+    logger.info(f"Processing redaction for jobs: {', '.join(job_names)}")
+    jobs_by_language = {}
+    results = io_pool.map(get_transcription_result, job_names)
+    for (job_name, language), transcription_timeline in zip(batch, results):
+        if transcription_timeline and len(transcription_timeline) > 0:
+            jobs_by_language.setdefault(comprehend_language(language), []).append((job_name, transcription_timeline))
+        else:
+            logger.info(f"No transcription timeline found for job: {job_name}")
+
+    uploads = {}
+    for language, jobs in jobs_by_language.items():
+        timelines = [timeline for _, timeline in jobs]
+        if use_transcribe_redaction:
+            redacted_tls, pattern_redacted = timelines, set()
+        else:
+            # Keep a failure to the jobs of one language instead of the whole batch
+            try:
+                redacted_tls, pattern_redacted = detect_pii_entities(timelines, language)
+            except Exception as e:
+                logger.error(f"Error redacting jobs {', '.join(job_name for job_name, _ in jobs)}: {e}")
+                continue
+        for index, ((job_name, _), redacted_tl) in enumerate(zip(jobs, redacted_tls)):
+            redacted_key = f'redacted_{job_name}.json'
+            body = json.dumps(redacted_tl)
+            # Pattern matching is only a stopgap, so mark those results for the next
+            # run to redact again, and keep them out of the cache
+            metadata = {'pii-fallback': 'patterns'} if index in pattern_redacted else {}
+            uploads[redacted_key] = io_pool.submit(
+                s3.put_object, Bucket=redaction_bucket, Key=redacted_key, Body=body, Metadata=metadata
+            )
+            cache_key = batch_cache_keys[job_name]
+            if cache_key and index not in pattern_redacted:
+                uploads[cache_key] = io_pool.submit(
+                    s3.put_object, Bucket=redaction_bucket, Key=cache_key, Body=body
+                )
+
+    for redacted_key, upload in uploads.items():
+        try:
+            upload.result()
+            logger.info(f'Saved redacted transcription to {redacted_key}')
+        except (BotoCoreError, ClientError) as e:
+            logger.error(f'Error saving redacted transcription to {redacted_key}: {e}')
+
+def drain_redaction_queue():
+    """Take the next batch of completed (job name, language code) pairs off the redaction queue, or an empty list if there are none."""
+    # One worker forms a batch at a time, so completed jobs are collected into
+    # full batches instead of being spread one by one across the idle workers
+    with drain_lock:
+        # Nothing can arrive once all transcriptions are complete, so workers
+        # waiting for the lock exit at once instead of waiting in turn
+        if all_transcriptions_complete.is_set() and redaction_queue.empty():
+            return []
+        try:
+            batch = [redaction_queue.get(timeout=5)]
+        except Empty:
+            return []
+        # Top the batch up until it is full or REDACTION_BATCH_WAIT has passed since its first job
+        deadline = time.monotonic() + REDACTION_BATCH_WAIT
+        while len(batch) < REDACTION_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(redaction_queue.get(timeout=remaining))
+            except Empty:
+                break
+    return batch
 
 def redact_and_save_transcriptions():
     """Worker to read transcriptions, redact PII, and save to the redaction bucket."""
-    global completed_jobs
-    total_jobs = 0
     while not all_transcriptions_complete.is_set() or not redaction_queue.empty():
-        try:
-            job_name = redaction_queue.get(timeout=5)
-            print(f"Processing redaction for job: {job_name}")
-            transcription_timeline, language = get_transcription_result(job_name)
-            if transcription_timeline and len(transcription_timeline) > 0:
-                redacted_tl = detect_pii_entities(transcription_timeline, "en")
-                redacted_key = f'redacted_{job_name}.json'
-                s3.put_object(Bucket=redaction_bucket, Key=redacted_key, Body=json.dumps(redacted_tl))
-                print(f'Saved redacted transcription to {redacted_key}')
-                total_jobs += 1
-            else:
-                print(f"No transcription timeline found for job: {job_name}")
-            redaction_queue.task_done()
-        except Empty:
-            if all_transcriptions_complete.is_set() and total_jobs == completed_jobs:
+        batch = drain_redaction_queue()
+        if not batch:
+            if all_transcriptions_complete.is_set():
                 break
-            print("Redaction queue is empty, waiting...")
+            logger.info("Redaction queue is empty, waiting...")
             continue
+        try:
+            redact_jobs(batch)
         except Exception as e:
-            print(f"Error in redaction process: {e}")
+            logger.error(f"Error in redaction process for jobs {', '.join(job_name for job_name, _ in batch)}: {e}")
+        for _ in batch:
+            redaction_queue.task_done()
     all_redactions_complete.set()
-    print("All redactions have been completed.")
+    logger.info("All redactions have been completed.")
 
 if __name__ == "__main__":
-    # Populate the audio file queue
-    audio_files = list_files(input_bucket)
-    total_jobs = len(audio_files)
-    for audio_file in audio_files:
-        audio_file_queue.put(audio_file)
-    
-    # Thread pool executor for concurrency
-    with ThreadPoolExecutor(max_workers=thread_count) as executor:
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+    # One thread pool per stage so a slow stage cannot starve the others
+    with (
+        ThreadPoolExecutor(max_workers=1) as starter,
+        ThreadPoolExecutor(max_workers=status_pollers) as pollers,
+        ThreadPoolExecutor(max_workers=redaction_workers) as redactors,
+    ):
         # Start job management
-        executor.submit(manage_transcription_jobs)
+        starter.submit(manage_transcription_jobs)
         
         # Start transcription status checkers
-        for _ in range(int(thread_count/2)):
-            executor.submit(check_transcription_job_status)
+        for _ in range(status_pollers):
+            pollers.submit(check_transcription_job_status)
         
         # Start redaction workers
-        for _ in range(int(thread_count/2)):
-            executor.submit(redact_and_save_transcriptions)
+        for _ in range(redaction_workers):
+            redactors.submit(redact_and_save_transcriptions)
+        
+        # Populate the audio file queue while the workers are running
+        try:
+            for audio_file in list_audio_files():
+                audio_file_queue.put(audio_file)
+        except Exception as e:
+            # Carry on with the files queued so far, the workers only stop once the queues are drained
+            logger.error(f'Error listing files in {input_bucket}: {e}')
         
         # Wait for all audio files to be processed
         audio_file_queue.join()
         all_files_processed.set()
-        print("All files have been processed.")
+        logger.info("All files have been processed.")
         
         # Wait for all transcriptions to complete
         transcription_queue.join()
         all_transcriptions_complete.set()
-        print("All transcriptions have been completed.")
+        logger.info("All transcriptions have been completed.")
         
         # Wait for all redactions to complete
         redaction_queue.join()
-        print("All redactions have been completed.")
+        logger.info("All redactions have been completed.")
 
     # Wait for all flags to be set
     all_files_processed.wait()
     all_transcriptions_complete.wait()
     all_redactions_complete.wait()
 
-    print(f"Total jobs processed: {completed_jobs}")
-    print("All tasks completed. Exiting the script.")
\ No newline at end of file
+    io_pool.shutdown()
+    # The counter starts at 0 and was advanced once per job, so this returns the total
+    logger.info(f"Total jobs processed: {next(completed_jobs)}")
+    logger.info("All tasks completed. Exiting the script.")
\ No newline at end of file